@@ -0,0 +1,823 @@
+# Benchmark of cluster_analysis.py on synthetic source files, so the performance can be
+# measured on any machine without the confidential exports.
+# The generators write the seven sources with the sheets, columns, header rows and
+# footers the readers expect (the files with a footer as Excel saves them), then the
+# pipeline runs end to end through main() and the time and memory of every stage
+# come from its StageProfiler.
+#
+#   python benchmark.py --rows 10000 100000 --output-format parquet
+#   python benchmark.py --rows 5000000 --sales-in-memory
+#   python benchmark.py --rows 100000 -- --chunk-rows 20000   (args after -- go to main)
+#   python benchmark.py --micro --rows 100000 1000000   (cleaning steps alone)
+#   python benchmark.py --parity --duplicate-rate 0.01   (pandas and lazy engines)
+#
+# An excel sheet holds at most about 1M rows, bigger sizes (or --sales-in-memory) skip
+# the sales excel file: the sales are generated in memory and go through the same
+# stages from clean_sales on.
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import zipfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import cluster_analysis as ca
+
+# text columns of the sales export that are not keys, a few values each
+SALES_TEXT_COLUMNS = [
+    "Region Of Origin",
+    "Subregion Of Origin",
+    "TOP KAM",
+    "KAM",
+    "Tagetik Plant Geography 2021 Hierarchy - Region",
+    "Tagetik Plant Geography 2021 Hierarchy - Subregion",
+    "Tagetik Plant Geography 2021 Hierarchy - Country",
+    "Tagetik Plant",
+    "Plant Of Origin",
+    "Cluster Of Origin",
+    "BL Hierarchy - Sibelco Business Line Name",
+    "BL Hierarchy - Sibelco Sub Business Line Name",
+    "BL Hierarchy - Sibelco Business Market Name",
+    "BL Hierarchy - SIC Code Description",
+    "Country Hierarchy - Continent",
+    "Country Hierarchy - Country",
+    "Key Account Name",
+    "Commercial Hierarchy - Organization Level 1",
+    "Commercial Hierarchy - Organization Level 2",
+    "Commercial Hierarchy - Organization Level 3",
+    "Commercial Hierarchy - Organization Level 4",
+    "Commercial Hierarchy - Organization Level 5",
+    "Sales Responsible Email",
+    "SPC Hierarchy - SPC Group Code Description",
+    "SPC Hierarchy - SPC Category Code Description",
+    "SPC Hierarchy - SPC Code Description",
+    "SPC Hierarchy - Cluster Code Description",
+    "Incoterm",
+    "Tran Curr Code",
+    "Customer Segment Code",
+    "Shipped To City Name",
+    "M&A",
+    "GR",
+    "Type of Mineral",
+    "Sold in both periods",
+]
+# numeric columns of the sales export
+SALES_NUMBER_COLUMNS = [
+    "Last Price Pres LY",
+    "ASP Pres CY",
+    "ASP Tran CY",
+    "Last Price Tran LY",
+    "Volume Ton CY YTD",
+    "Volume Ton LY FY",
+    "Volume Ton LY YTD",
+    "Revenue Pres Curr CY YTD",
+    "Revenue Pres Curr LY FY",
+    "Revenue Pres Curr LY YTD",
+    "Revenue Tran Curr CY YTD",
+    "Revenue Tran Curr LY FY",
+    "Revenue Tran Curr LY YTD",
+    "EXW Last Price Pres LY",
+    "Transport Last Price Pres LY",
+    "Revenue EXW Pres Curr",
+    "Transportation Cost (Third party) Pres Curr",
+    "EXW Revenue LY FY",
+    "Transportation Cost LY FY",
+    "Revenue EXW Pres Curr LY",
+    "Transportation Cost (Third party) Pres Curr LY",
+    "Revenue Pres Curr LY YTD\n@Last Price",
+    "Revenue Pres Curr CY YTD\n@Last Price",
+    "EXW Revenue Pres Curr LY YTD\n@Last Price",
+    "EXW Revenue Pres Curr CY YTD\n@Last Price",
+    "EXW Last Price Tran LY",
+    "Transport Last Price Tran LY",
+    "Revenue EXW Tran Curr",
+    "Transportation Cost (Third party) Tran Curr",
+    "EXW Revenue Tran LY FY",
+    "Transportation Cost Tran LY FY",
+    "Revenue EXW Tran Curr LY",
+    "Transportation Cost (Third party) Tran Curr LY",
+    "EXW ASP Pres CY_v3",
+    "EXW ASP Tran CY_v3",
+    "Transport ASP Pres CY_v3",
+    "Transport ASP Tran CY_v3",
+    "FX CY",
+    "FX LY",
+    "Price Effect %_CALCULATION",
+    "Price impact LY YTD",
+    "Volume impact LY",
+    "FX impact LY YTD",
+    "Price impact LY YTD (w_v1)",
+    "EXW Price impact LY YTD (w_v1)",
+    "Transport Price impact LY YTD (w_v1)",
+    "Price Impact EXW LY YTD",
+    "Volume impact EXW LY",
+    "FX impact EXW LY",
+    "Price Increase w_v1",
+    "Price Increase",
+    "Diff",
+]
+
+
+class Universe:
+    # the key values shared by all the sources: items, plants (SAP code and MDM
+    # location code), legal entities with their sales org, customers
+    def __init__(self, items, plants, legal_entities, customers, rng):
+        self.items = rng.choice(np.arange(100000, 1000000), items, replace=False)
+        self.plants = np.array([f"P{number:03d}" for number in range(plants)])
+        self.locations = np.array([f"L{number:04d}" for number in range(plants)])
+        self.legal_entities = np.arange(1000, 1000 + legal_entities)
+        self.sales_orgs = np.array(
+            [f"S{number:03d}" for number in range(legal_entities)]
+        )
+        self.customers = np.arange(1000000, 1000000 + customers)
+
+
+def generate_sales(universe, rows, rng):
+    # the "Values vs YTD" sheet, with the columns read_sales drops. Text columns are
+    # categorical to keep the memory of big sizes down
+    plant = rng.integers(0, len(universe.plants), rows)
+    item = rng.integers(0, len(universe.items), rows)
+    legal_entity = rng.integers(0, len(universe.legal_entities), rows)
+    customer = rng.integers(0, len(universe.customers), rows)
+    sales = {}
+    for column in SALES_TEXT_COLUMNS:
+        sales[column] = pd.Categorical.from_codes(
+            rng.integers(0, 3, rows), [f"{column[:12]} {value}" for value in "ABC"]
+        )
+    sales["Location Of Distribution"] = pd.Categorical.from_codes(
+        plant, [f"{location} Warehouse" for location in universe.locations]
+    )
+    sales["Item"] = pd.Categorical.from_codes(
+        item, [f"{number} Sand grade {number % 7}" for number in universe.items]
+    )
+    sales["Tagetik Legal Entity"] = pd.Categorical.from_codes(
+        legal_entity, [f"{code} Legal Entity" for code in universe.legal_entities]
+    )
+    # a few empty and financial (SLM_) customers, removed by the pipeline
+    customer_names = [f"{code} Customer" for code in universe.customers]
+    customer = np.where(rng.random(rows) < 0.02, len(customer_names), customer)
+    customer = np.where(rng.random(rows) < 0.02, len(customer_names) + 1, customer)
+    sales["Country Hierarchy - Customer"] = pd.Categorical.from_codes(
+        customer, customer_names + ["-", "SLM_internal"]
+    )
+    sales["JV"] = pd.Categorical.from_codes(
+        (rng.random(rows) < 0.05).astype(int), ["NO", "YES"]
+    )
+    for column in SALES_NUMBER_COLUMNS:
+        sales[column] = rng.normal(100, 30, rows).round(4)
+    sales["EXW Last Price Pres LY"][rng.random(rows) < 0.001] = np.inf
+    for column in ca.SALES_COLUMNS_TO_REMOVE:
+        sales[column] = pd.Categorical.from_codes(np.zeros(rows, dtype=int), ["x"])
+    return pd.DataFrame(sales), (plant, item, legal_entity, customer)
+
+
+def generate_dimensions(universe, sales_keys, conditions, duplicate_rate, rng):
+    # the lookup tables (sheets of mdm, LP, sales org, ZCPR, std costs, SAP costs).
+    # duplicate_rate of the rows of LP, ZCPR, std costs and SAP costs are repeated,
+    # they are the duplicate keys the pipeline warns about
+    plant, item, legal_entity, customer = sales_keys
+    locations = pd.DataFrame(
+        {
+            "SAPCode": universe.plants,
+            "LocationCode": universe.locations,
+            "Status": "Active",
+            "Name": [f"Location {code}" for code in universe.plants],
+        }
+    )
+    legal_entities = pd.DataFrame(
+        {
+            "Code": universe.legal_entities,
+            "Name": [f"Legal Entity {code}" for code in universe.legal_entities],
+        }
+    )
+
+    def item_plant_pairs(share):
+        # a share of all the item x plant combinations
+        items, plants = np.meshgrid(
+            np.arange(len(universe.items)), np.arange(len(universe.plants))
+        )
+        keep = rng.random(items.size) < share
+        return items.ravel()[keep], plants.ravel()[keep]
+
+    items, plants = item_plant_pairs(0.5)
+    list_prices = pd.DataFrame(
+        {
+            "ItemNumber": universe.items[items],
+            "Packaging": "BULK",
+            "Del.WHS CODE": universe.plants[plants],
+            "List Price LOC CURR": rng.normal(150, 20, len(items)).round(2),
+            "Currency Code": "EUR",
+            "List Price EUR": rng.normal(150, 20, len(items)).round(2),
+            "PL.ValidFrom": pd.Timestamp("2025-01-01"),
+            "PL.ValidTo": pd.Timestamp("2025-12-31"),
+            "Origin Plant": "x",
+            "ItemName": "x",
+            "Product": "x",
+            "Delivery WHS": "x",
+        }
+    )
+    sales_org = pd.DataFrame(
+        {
+            "legalentitycode": universe.legal_entities,
+            "salesorganization": universe.sales_orgs,
+            "Legal Entity Code Name": "x",
+            "CONDITIONTYPE": "ZCPR",
+            "_RecordCount": 1,
+        }
+    )
+    # conditions of combinations sold, so they match
+    pick = rng.integers(0, len(plant), conditions)
+    valid_customer = customer[pick] < len(universe.customers)
+    pick = pick[valid_customer]
+    zcpr = pd.DataFrame(
+        {
+            "Sold-To": [
+                f"{code} Customer" for code in universe.customers[customer[pick]]
+            ],
+            "Sold-To Segment": "A",
+            "Sold-To Status": "Active",
+            "Delivery Warehouse": universe.plants[plant[pick]],
+            "Item": [f"{code} Sand" for code in universe.items[item[pick]]],
+            "Customer Price": rng.normal(140, 20, len(pick)).round(2),
+            "Currency": "EUR",
+            "UoM": "TO",
+            "Customer Price EUR/TO": rng.normal(140, 20, len(pick)).round(2),
+            "Valid From": pd.Timestamp("2025-01-01"),
+            "Valid To": pd.Timestamp("2025-12-31"),
+            "Discount Product List Price (%)": rng.random(len(pick)).round(3),
+            "Sales Org": universe.sales_orgs[legal_entity[pick]],
+            "Condition Type": "ZCPR",
+            "Has Quantity Scaling": "No",
+        }
+    )
+    for column in [
+        "Sold-To Country",
+        "Delivery Warehouse Name",
+        "Product List Price",
+        "List Price Currency",
+        "List Price EUR/TO",
+        "List Price Valid From",
+        "List Price Valid To",
+        "List Price Status",
+        "Legal Entity",
+        "Customer Sales Manager",
+        "Price Validity",
+        "Created On",
+        "Created By",
+        "Last Modified On",
+        "Last Modified By",
+    ]:
+        zcpr[column] = "x"
+    items, plants = item_plant_pairs(0.6)
+    stdcosts = pd.DataFrame(
+        {
+            "Item Number Name": [f"{code} Sand" for code in universe.items[items]],
+            "Variable Cost / Mt": rng.normal(50, 5, len(items)).round(3),
+            "Fixed Cost / Mt": rng.normal(20, 5, len(items)).round(3),
+            "Distribution Cost / Mt": rng.normal(5, 1, len(items)).round(3),
+            "Other / Mt": rng.normal(2, 1, len(items)).round(3),
+            "COGS Total / Mt": rng.normal(80, 5, len(items)).round(3),
+            "Depreciation / Mt": rng.normal(8, 1, len(items)).round(3),
+            "COGS(depr) Total / Mt": rng.normal(88, 5, len(items)).round(3),
+            "Plant Code": universe.plants[plants],
+            "ValidFromDate": pd.Timestamp("2025-01-01"),
+            "ValidToDate": pd.Timestamp("2025-12-31"),
+            "Profit Center": "x",
+        }
+    )
+    items, plants = item_plant_pairs(0.6)
+    sapcosts = generate_sap_export(universe, items, plants, rng)
+    tables = [list_prices, zcpr, stdcosts, sapcosts]
+    list_prices, zcpr, stdcosts, sapcosts = [
+        pd.concat(
+            [table, table.sample(frac=duplicate_rate, random_state=rng)],
+            ignore_index=True,
+        )
+        for table in tables
+    ]
+    return {
+        "mdm": {"SAPLocations": locations, "SAPLegalEntities": legal_entities},
+        "lp": list_prices,
+        "so": sales_org,
+        "zcpr": zcpr,
+        "stdcosts": stdcosts,
+        "sapcosts": sapcosts,
+    }
+
+
+def generate_sap_export(universe, items, plants, rng):
+    # SAP export: padded column names and codes, prices with comma decimals and dot
+    # thousands, "..." for missing units and currencies
+    prices = rng.normal(900, 400, len(items)).round(2)
+    return pd.DataFrame(
+        {
+            " Material ": universe.items[items],
+            "Plnt ": [f" {code} " for code in universe.plants[plants]],
+            "BUn": rng.choice(["TO ", " KG", "..."], len(items)),
+            " Price": [
+                f"{price:,.2f}".replace(",", " ").replace(".", ",").replace(" ", ".")
+                for price in prices
+            ],
+            "Crcy": rng.choice(["EUR", "..."], len(items)),
+            "Descr": "x",
+        }
+    )
+
+
+def write_sheets(path, sheets, footer=False, empty_rows_above=0):
+    # Write the frames as the sheets of an xlsx file with the streaming writer of the
+    # pipeline. footer adds the "Applied filters" line of the power BI exports,
+    # empty_rows_above puts the header lower like the SAP export
+    workbook = ca.open_workbook(path)
+    for name, frame in sheets.items():
+        sheet = workbook.add_worksheet(name)
+        for number in range(empty_rows_above):
+            sheet.write_row(number, 0, ["SAP export"] if number == 0 else [])
+        sheet.write_row(empty_rows_above, 0, [str(column) for column in frame.columns])
+        number = empty_rows_above + 1
+        for row in ca.excel_rows(frame):
+            sheet.write_row(number, 0, row)
+            number += 1
+        if footer:
+            sheet.write_row(number, 0, ["Applied filters: none"])
+    workbook.close()
+
+
+# what Excel adds to the xml of a sheet when it saves the file: the x14ac namespace on
+# the worksheet and a prefixed attribute on every row
+EXCEL_NAMESPACES = (
+    b' xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006"'
+    b' mc:Ignorable="x14ac"'
+    b' xmlns:x14ac="http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac"'
+)
+EXCEL_ROW_ATTRIBUTES = b' x14ac:dyDescent="0.25"'
+
+
+def save_as_excel(path):
+    # Rewrite the sheets of an xlsx file as Excel saves them (EXCEL_NAMESPACES), the
+    # exports opened and saved again by someone before the run look like this
+    temporary = path + ".tmp"
+    with zipfile.ZipFile(path) as source, zipfile.ZipFile(
+        temporary, "w", zipfile.ZIP_DEFLATED
+    ) as target:
+        for item in source.infolist():
+            with source.open(item) as reader, target.open(
+                item.filename, "w", force_zip64=True
+            ) as writer:
+                if not item.filename.startswith("xl/worksheets/"):
+                    shutil.copyfileobj(reader, writer)
+                    continue
+                rest = b""
+                for block in iter(lambda: reader.read(1024 * 1024), b""):
+                    # a tag cut at the end of the block goes with the next one
+                    block = rest + block
+                    cut = max(block.rfind(b"<"), 0)
+                    block, rest = block[:cut], block[cut:]
+                    block = block.replace(
+                        b"<worksheet ", b"<worksheet" + EXCEL_NAMESPACES + b" ", 1
+                    )
+                    writer.write(
+                        block.replace(b"<row ", b"<row" + EXCEL_ROW_ATTRIBUTES + b" ")
+                    )
+                writer.write(rest)
+    os.replace(temporary, path)
+
+
+def generate_sources(directory, settings):
+    # Write the seven source files in directory (kept and reused for the same
+    # parameters). Returns (paths by role, the sales frame when it is not written)
+    parameters = {
+        key: getattr(settings, key)
+        for key in [
+            "items",
+            "plants",
+            "legal_entities",
+            "customers",
+            "conditions",
+            "duplicate_rate",
+            "seed",
+        ]
+    }
+    parameters["rows"] = settings.current_rows
+    parameters["sales_in_memory"] = settings.current_in_memory
+    # version of the generated files, those written before the footer sources were
+    # saved as Excel does are generated again
+    parameters["version"] = 2
+    key = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+    directory = os.path.join(directory, f"sources_{settings.current_rows}_{key[:8]}")
+    paths = {role: os.path.join(directory, f"{role}.xlsx") for role in ca.SOURCE_ROLES}
+    done = os.path.join(directory, "parameters.json")
+    if os.path.exists(done) and not settings.current_in_memory:
+        return paths, None
+    # same seed, the sales generated in memory match the lookup tables written
+    rng = np.random.default_rng(settings.seed)
+    universe = Universe(
+        settings.items,
+        settings.plants,
+        settings.legal_entities,
+        settings.customers,
+        rng,
+    )
+    sales, sales_keys = generate_sales(universe, settings.current_rows, rng)
+    if not os.path.exists(done):
+        print(f"Generating the sources in {directory}")
+        os.makedirs(directory, exist_ok=True)
+        # the ZCPR file has to fit in an excel sheet too
+        conditions = settings.conditions or min(
+            max(settings.current_rows // 2, 1), ca.EXCEL_MAX_ROWS // 2
+        )
+        dimensions = generate_dimensions(
+            universe, sales_keys, conditions, settings.duplicate_rate, rng
+        )
+        write_sheets(paths["mdm"], dimensions["mdm"])
+        for role in ["lp", "so", "zcpr", "stdcosts"]:
+            write_sheets(paths[role], {"Sheet1": dimensions[role]}, footer=True)
+            save_as_excel(paths[role])
+        write_sheets(
+            paths["sapcosts"], {"Sheet1": dimensions["sapcosts"]}, empty_rows_above=4
+        )
+        if not settings.current_in_memory:
+            write_sheets(paths["sales"], {"Values vs YTD": sales})
+        # written last, a directory without it is regenerated
+        with open(done, "w", encoding="UTF8") as parameters_file:
+            json.dump(parameters, parameters_file)
+    return paths, sales if settings.current_in_memory else None
+
+
+def pipeline_settings(paths, settings):
+    # the settings of cluster_analysis.main() for the generated sources
+    argv = [
+        "--sales",
+        paths["sales"],
+        "--mdm",
+        paths["mdm"],
+        "--LP",
+        paths["lp"],
+        "--so",
+        paths["so"],
+        "--zcpr",
+        paths["zcpr"],
+        "--stdcosts",
+        paths["stdcosts"],
+        "--sapcosts",
+        paths["sapcosts"],
+        "--output-format",
+        *settings.output_formats,
+        "--no-cache",
+    ] + settings.pipeline_args
+    return ca.build_parser().parse_args(argv)
+
+
+def run_pipeline(paths, sales, settings, output_directory):
+    # One run of the pipeline in output_directory. Returns the wall time of the run
+    # and the StageProfiler records of its stages
+    pipeline = pipeline_settings(paths, settings)
+    os.makedirs(output_directory, exist_ok=True)
+    current_directory = os.getcwd()
+    os.chdir(output_directory)
+    try:
+        start = time.perf_counter()
+        if sales is None:
+            ca.main(pipeline)
+        else:
+            run_stages(pipeline, sales)
+        wall = time.perf_counter() - start
+    finally:
+        os.chdir(current_directory)
+    return wall, list(ca.profiler.stages.values())
+
+
+def run_stages(settings, sales):
+    # the stages of main() from clean_sales on, for sales generated in memory
+    ca.write_to_log = lambda message: ca.write_log_file(None, message)
+    profiler = ca.profiler = ca.StageProfiler()
+    sales, tables, dictionaries, table_codes = lookup_inputs(settings, sales)
+    plan = profiler.run(
+        "build_lookup_plan",
+        ca.PLAN_BUILDERS[settings.engine],
+        sales,
+        tables,
+        dictionaries,
+        table_codes,
+    )
+    sales = profiler.run("gather_lookups", ca.gather_lookups, sales, tables, plan)
+    sales = profiler.run("add_kpis", ca.add_kpis, sales)
+    sales = profiler.run(
+        "add_segment_benchmarks",
+        ca.add_segment_benchmarks,
+        sales,
+        settings.segment_by,
+    )
+    sales = profiler.run(
+        "rename_columns_and_adjustments",
+        ca.rename_columns_and_adjustments,
+        sales,
+        settings.all_columns,
+    )
+    cubes = (
+        None
+        if settings.no_cubes
+        else profiler.run("build_cubes", ca.build_cubes, sales)
+    )
+    profiler.run(
+        "finalize_and_save",
+        ca.finalize_and_save,
+        sales,
+        settings.output_formats,
+        settings.parquet_compression,
+        cubes,
+    )
+
+
+def lookup_inputs(settings, sales):
+    # the sales cleaned like read_sales does, the lookup tables and their key codes
+    profiler = ca.profiler
+    sales = sales.drop(columns=ca.SALES_COLUMNS_TO_REMOVE)
+    sales = profiler.run("clean_sales", ca.clean_sales, sales)
+    if not settings.no_compact:
+        sales = profiler.run("compact_dtypes read_sales", ca.compact_source, sales, [])
+    tables = ca.lookup_tables(ca.load_sources(settings, ca.SOURCE_ROLES[1:]))
+    tables, dictionaries, table_codes = ca.prepare_lookup_tables(tables, settings)
+    return sales, tables, dictionaries, table_codes
+
+
+def benchmark_engines(settings, started):
+    # the lookup plan built by every --engine of the pipeline on the same inputs: the
+    # time of each and the parity of the dataset they give (before the renaming,
+    # KPIs included), which must be the same column for column: a difference stops
+    # the benchmark with an error once every size is done
+    results = []
+    differences = []
+    for rows in settings.rows:
+        settings.current_rows = rows
+        settings.current_in_memory = True
+        paths, sales = generate_sources(settings.workdir, settings)
+        output_directory = os.path.join(settings.workdir, f"output_{rows}")
+        os.makedirs(output_directory, exist_ok=True)
+        current_directory = os.getcwd()
+        os.chdir(output_directory)
+        try:
+            ca.write_to_log = lambda message: ca.write_log_file(None, message)
+            ca.profiler = ca.StageProfiler()
+            pipeline = pipeline_settings(paths, settings)
+            sales, tables, dictionaries, table_codes = lookup_inputs(pipeline, sales)
+        finally:
+            os.chdir(current_directory)
+        for repeat in range(1, settings.repeat + 1):
+            run = {"started": started, "rows": rows, "run": repeat}
+            outputs = {}
+            timings = []
+            for engine, build in ca.PLAN_BUILDERS.items():
+                start = time.perf_counter()
+                # the sales values missing from the dictionaries are added to them
+                plan = build(sales, tables, dict(dictionaries), table_codes)
+                wall = time.perf_counter() - start
+                outputs[engine] = ca.add_kpis(ca.gather_lookups(sales, tables, plan))
+                stage = f"build_lookup_plan ({engine})"
+                results.append(dict(run, stage=stage, calls=1, wall_s=wall))
+                timings.append(f"{engine} {wall:.3f} s")
+            reference = outputs.pop("pandas")
+            verdict = "same output"
+            for engine, output in outputs.items():
+                try:
+                    pd.testing.assert_frame_equal(reference, output)
+                except AssertionError as error:
+                    verdict = "DIFFERENT OUTPUT"
+                    differences.append(f"{engine}, {rows} rows, run {repeat}: {error}")
+            print(f"{rows} rows, run {repeat}: {', '.join(timings)}, {verdict}")
+    if differences:
+        raise SystemExit(
+            "The engines do not give the same dataset:\n" + "\n".join(differences)
+        )
+    return results
+
+
+def clean_sapcosts_reference(sapcosts):
+    # clean_sapcosts before it parsed the distinct values only: string methods and the
+    # regex run on every row. Kept for the micro benchmark, which checks that both
+    # give the same frame
+    columns_to_keep = ["Material", "Plnt", "BUn", "Price", "Crcy"]
+    sapcosts.columns = sapcosts.columns.str.strip()
+    sapcosts["Price"] = (
+        sapcosts["Price"]
+        .astype(str)
+        .str.replace(".", "", regex=False)
+        .str.replace(",", ".", regex=False)
+        .str.extract(r"(\d+\.?\d*)")[0]
+        .astype(float)
+    )
+    sapcosts["BUn"] = (
+        sapcosts["BUn"].astype(str).str.strip().replace("...", "", regex=False)
+    )
+    sapcosts["Crcy"] = (
+        sapcosts["Crcy"].astype(str).str.strip().replace("...", "", regex=False)
+    )
+    sapcosts = sapcosts[columns_to_keep]
+    sapcosts = sapcosts[sapcosts["Material"] != "0"]
+    sapcosts["Material"] = sapcosts["Material"].astype("Int64")
+    sapcosts["Material"] = sapcosts["Material"].astype(str)
+    sapcosts["Plnt"] = sapcosts["Plnt"].str.strip()
+    sapcosts = sapcosts[
+        ~(
+            sapcosts["Material"].str.startswith("1")
+            | sapcosts["Material"].str.startswith("8")
+            | sapcosts["Material"].str.startswith("5")
+            | sapcosts["Material"].str.startswith("2")
+            | sapcosts["Material"].str.startswith("3")
+        )
+    ]
+    sapcosts["sapcosts-key"] = sapcosts["Material"] + "|" + sapcosts["Plnt"]
+    return sapcosts
+
+
+# cleaning steps timed alone by --micro: name, current version, reference version
+MICRO_BENCHMARKS = [
+    ("clean_sapcosts", ca.clean_sapcosts, clean_sapcosts_reference),
+]
+
+
+def benchmark_cleaning(settings, started):
+    # the cleaning steps alone on in-memory exports of --rows rows, against the
+    # reference versions, whose output must be the same
+    rng = np.random.default_rng(settings.seed)
+    universe = Universe(
+        settings.items,
+        settings.plants,
+        settings.legal_entities,
+        settings.customers,
+        rng,
+    )
+    results = []
+    for rows in settings.rows:
+        items = rng.integers(0, len(universe.items), rows)
+        plants = rng.integers(0, len(universe.plants), rows)
+        exports = {
+            "clean_sapcosts": generate_sap_export(universe, items, plants, rng).drop(
+                columns="Descr"
+            )
+        }
+        for repeat in range(1, settings.repeat + 1):
+            run = {"started": started, "rows": rows, "run": repeat}
+            for name, function, reference in MICRO_BENCHMARKS:
+                timings = []
+                outputs = []
+                for version in [reference, function]:
+                    export = exports[name].copy()
+                    start = time.perf_counter()
+                    with pd.option_context("mode.chained_assignment", None):
+                        outputs.append(version(export))
+                    timings.append(time.perf_counter() - start)
+                pd.testing.assert_frame_equal(*outputs)
+                print(
+                    f"{rows} rows, run {repeat}: {name} {timings[1]:.3f} s, "
+                    f"reference {timings[0]:.3f} s ({timings[0] / timings[1]:.1f}x)"
+                )
+                results.append(
+                    dict(run, stage=f"{name} (reference)", calls=1, wall_s=timings[0])
+                )
+                results.append(dict(run, stage=name, calls=1, wall_s=timings[1]))
+    return results
+
+
+def benchmark_pipeline(settings, started):
+    results = []
+    for rows in settings.rows:
+        settings.current_rows = rows
+        settings.current_in_memory = settings.sales_in_memory or (
+            rows >= ca.EXCEL_MAX_ROWS
+        )
+        paths, sales = generate_sources(settings.workdir, settings)
+        for repeat in range(1, settings.repeat + 1):
+            output_directory = os.path.join(settings.workdir, f"output_{rows}")
+            wall, stages = run_pipeline(paths, sales, settings, output_directory)
+            print(f"{rows} rows, run {repeat}: {wall:.2f} s")
+            run = {"started": started, "rows": rows, "run": repeat}
+            results.append(dict(run, stage="total", calls=1, wall_s=wall))
+            results += [dict(run, **record) for record in stages]
+    return results
+
+
+def main(settings):
+    started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # the pipeline runs in the output folders, the generated paths must not depend
+    # on the current directory
+    settings.workdir = os.path.abspath(settings.workdir)
+    if settings.micro:
+        results = benchmark_cleaning(settings, started)
+    elif settings.parity:
+        results = benchmark_engines(settings, started)
+    else:
+        results = benchmark_pipeline(settings, started)
+    results = pd.DataFrame(results)
+    summary = results.pivot_table(
+        index="stage", columns="rows", values="wall_s", aggfunc="median", sort=False
+    )
+    print("\nMedian wall time (s) of every stage by number of rows")
+    print(summary.round(3).to_string())
+    # appended, to follow the timings across versions of the pipeline
+    first = not os.path.exists(settings.results)
+    results.to_csv(settings.results, mode="a", header=first, index=False)
+    print(f"\nResults appended to {settings.results}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of cluster_analysis.py on synthetic source files"
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10000, 100000],
+        help="Number(s) of sales rows to benchmark, from 10k to 10M (default 10000 100000).",
+        metavar="N",
+    )
+    parser.add_argument(
+        "--items", type=int, default=2000, help="Distinct items (default 2000)."
+    )
+    parser.add_argument(
+        "--plants",
+        type=int,
+        default=40,
+        help="Distinct plants / delivery warehouses (default 40).",
+    )
+    parser.add_argument(
+        "--legal-entities",
+        type=int,
+        default=20,
+        help="Distinct legal entities, one sales org each (default 20).",
+        dest="legal_entities",
+    )
+    parser.add_argument(
+        "--customers",
+        type=int,
+        default=20000,
+        help="Distinct customers (default 20000).",
+    )
+    parser.add_argument(
+        "--conditions",
+        type=int,
+        default=None,
+        help="Rows of the ZCPR file (default half the sales rows, at most 524288).",
+    )
+    parser.add_argument(
+        "--duplicate-rate",
+        type=float,
+        default=0.0,
+        help="Share of the rows of LP, ZCPR, std costs and SAP costs repeated with the same key (default 0).",
+        dest="duplicate_rate",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default 0).")
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Runs of every size (default 1)."
+    )
+    parser.add_argument(
+        "--output-format",
+        nargs="+",
+        choices=["xlsx", "parquet", "csv"],
+        default=["parquet"],
+        help="Output format(s) of the pipeline (default parquet).",
+        dest="output_formats",
+    )
+    parser.add_argument(
+        "--sales-in-memory",
+        action="store_true",
+        help="Do not write and parse the sales excel file, generate the sales in memory (always done above the excel row limit).",
+        dest="sales_in_memory",
+    )
+    parser.add_argument(
+        "--micro",
+        action="store_true",
+        help="Time the cleaning steps alone (SAP costs) against their previous version instead of running the pipeline.",
+    )
+    parser.add_argument(
+        "--parity",
+        action="store_true",
+        help="Build the lookup plan with every --engine of the pipeline (pandas, lazy) on the same inputs, check they give the same dataset and time them.",
+    )
+    parser.add_argument(
+        "--workdir",
+        default="benchmark_data",
+        help="Folder of the generated sources and of the outputs (default benchmark_data).",
+        metavar="path",
+    )
+    parser.add_argument(
+        "--results",
+        default="benchmark_results.csv",
+        help="CSV file the timings are appended to (default benchmark_results.csv).",
+        metavar="path",
+    )
+    parser.add_argument(
+        "pipeline_args",
+        nargs=argparse.REMAINDER,
+        help="Arguments after -- are given to cluster_analysis.py (e.g. -- --chunk-rows 20000).",
+    )
+    settings = parser.parse_args()
+    if settings.pipeline_args[:1] == ["--"]:
+        settings.pipeline_args = settings.pipeline_args[1:]
+    main(settings)